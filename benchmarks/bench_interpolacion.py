@@ -0,0 +1,105 @@
+# Benchmark de la superficie de temperaturas interpolada.
+#
+# Mide el tiempo de 'interpolate_temperature' sobre una malla de 200x200
+# puntos con distinto número de estaciones sintéticas, sin caché y con caché,
+# y el tiempo total de 'draw_weather_map' con la superficie activada, tanto
+# interpolando de nuevo (caché vacía) como con la superficie ya en caché.
+#
+# Uso:
+#     python benchmarks/bench_interpolacion.py
+import sys
+import time
+sys.path.insert(1, './')
+import operaciones_geomap
+from operaciones_geomap import *
+
+
+def synthetic_data(n_stations, bbox, seed = 0):
+    '''
+    USAGE:
+        Genera un DataFrame de estaciones con el mismo formato que el de
+        'get_weather_data' (incluida la fila final con la media) y
+        posiciones y temperaturas aleatorias dentro de 'bbox'.
+    INPUT
+        n_stations (int): Número de estaciones.
+        bbox (list): Lista con cuatro coordenadas [north, south, east, west].
+        seed (int): Semilla del generador aleatorio.
+    OUTPUT
+        df_meteo (DataFrame): Estaciones sintéticas.
+    '''
+    north, south, east, west = bbox
+    rng = np.random.RandomState(seed)
+    lat = rng.uniform(south, north, n_stations)
+    lng = rng.uniform(west, east, n_stations)
+    temperature = np.round(15 + 10 * np.sin(lat) + rng.normal(0, 2,
+                                                              n_stations), 1)
+    df_meteo = pd.DataFrame({'datetime': '2020-05-01 12:00:00',
+                             'stationName': ['EST' + str(i)
+                                             for i in range(n_stations)],
+                             'temperature': temperature,
+                             'humidity': rng.uniform(20, 90, n_stations),
+                             'windSpeed': rng.uniform(0, 20, n_stations),
+                             'clouds': '',
+                             'lat': lat,
+                             'lng': lng})
+    df_meteo = df_meteo.append({'datetime': '', 'stationName': '',
+                                'temperature':
+                                round(temperature.mean(), 1),
+                                'humidity': 50.0, 'windSpeed': 10.0,
+                                'clouds': '', 'lat': '', 'lng': ''},
+                               ignore_index=True)
+    return df_meteo
+
+
+def timeit(function, repeat = 5):
+    '''
+    USAGE:
+        Ejecuta 'function' 'repeat' veces y devuelve el mejor tiempo en ms.
+    '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+if __name__ == '__main__':
+    bbox = [41.0, 40.0, -3.0, -4.5]
+    df_data_geo = pd.DataFrame([{'asciiName': 'Madrid',
+                                 'bbox': {'north': bbox[0], 'south': bbox[1],
+                                          'east': bbox[2], 'west': bbox[3]},
+                                 'adminName1': 'Madrid',
+                                 'countryName': 'Spain', 'score': 1.0,
+                                 'lat': '40.4', 'lng': '-3.7',
+                                 'wiki_link': ''}])
+
+    print('estaciones  malla    sin caché (ms)  con caché (ms)  '
+          'mapa sin caché (ms)  mapa con caché (ms)')
+    for n_stations in [10, 100, 300, 500, 1000]:
+        df_data_meteo = synthetic_data(n_stations, bbox)
+        lat_est = list(df_data_meteo['lat'])[:-1]
+        lng_est = list(df_data_meteo['lng'])[:-1]
+        temp_est = list(df_data_meteo['temperature'])[:-1]
+        version = get_observation_version(df_data_meteo)
+
+        cold = timeit(lambda: interpolate_temperature(lat_est, lng_est,
+                                                      temp_est, bbox))
+        interpolate_temperature(lat_est, lng_est, temp_est, bbox,
+                                version=version)
+        cached = timeit(lambda: interpolate_temperature(lat_est, lng_est,
+                                                        temp_est, bbox,
+                                                        version=version))
+
+        def draw_cold():
+            operaciones_geomap._surface_cache.clear()
+            draw_weather_map(df_data_geo, df_data_meteo, 0, temp_surface=True)
+
+        full_cold = timeit(draw_cold, repeat=3)
+        draw_weather_map(df_data_geo, df_data_meteo, 0, temp_surface=True)
+        full_cached = timeit(lambda: draw_weather_map(df_data_geo,
+                                                      df_data_meteo, 0,
+                                                      temp_surface=True),
+                             repeat=3)
+        print(f'{n_stations:>10}  200x200  {cold:>14.1f}  {cached:>14.3f}'
+              f'  {full_cold:>19.1f}  {full_cached:>19.1f}')
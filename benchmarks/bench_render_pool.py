@@ -0,0 +1,91 @@
+# Benchmark del renderizado de la página de resultados en un pool de procesos.
+#
+# Simula un servidor con hilos: 'threads' hilos generan páginas go.html a la
+# vez, primero en el propio proceso (renderizado actual, limitado por el GIL)
+# y después enviándolas a un Render_Pool con 1, 2, 4... procesos hasta el
+# número de núcleos. Muestra las páginas por segundo de cada configuración,
+# sin y con la superficie de temperaturas. Cada página usa estaciones
+# distintas para que la superficie no salga de la caché.
+#
+# Uso:
+#     python benchmarks/bench_render_pool.py [estaciones] [páginas]
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(1, './')
+sys.path.insert(1, './benchmarks')
+from operaciones_render import *
+from bench_interpolacion import synthetic_data
+
+
+def throughput(render, n_pages, threads):
+    '''
+    USAGE:
+        Genera 'n_pages' páginas con 'threads' hilos llamando a 'render' y
+        devuelve las páginas por segundo.
+    '''
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda i: render(), range(n_pages)))
+    return n_pages / (time.perf_counter() - start)
+
+
+def run(temp_surface, n_stations, n_pages, threads, cores):
+    '''
+    USAGE:
+        Mide las páginas por segundo en el hilo y con pools de 1, 2, 4...
+        procesos hasta 'cores', con o sin superficie de temperaturas.
+    '''
+    bbox = [41.0, 40.0, -3.0, -4.5]
+    geo_row = {'asciiName': 'Madrid',
+               'bbox': {'north': bbox[0], 'south': bbox[1],
+                        'east': bbox[2], 'west': bbox[3]},
+               'adminName1': 'Madrid', 'countryName': 'Spain', 'score': 1.0,
+               'lat': '40.4', 'lng': '-3.7', 'wiki_link': ''}
+    template_args = {'city_name': 'Madrid', 'wiki_link': '',
+                     'candidates': [], 'elemento': 0,
+                     'temp_surface': temp_surface, 'degraded': False}
+    # una semilla distinta por página; la 0 se reserva para calentar
+    pages = [(geo_row, synthetic_data(n_stations, bbox, seed).to_dict('list'),
+              temp_surface, template_args)
+             for seed in range(n_pages + 1)]
+
+    def page_renderer(render):
+        counter = iter(pages[1:])
+        lock = threading.Lock()
+
+        def render_next():
+            with lock:
+                args = next(counter)
+            return render(*args)
+        return render_next
+
+    print(f'superficie: {"sí" if temp_surface else "no"}')
+    print('modo              páginas/s')
+    # calentamos plotly en este proceso antes de medir
+    render_go_page(*pages[0])
+    inline = throughput(page_renderer(render_go_page), n_pages, threads)
+    print(f'{"en el hilo":<16}  {inline:>9.1f}')
+
+    processes = 1
+    while processes <= cores:
+        render_pool = Render_Pool(processes, max_pending=threads)
+        render_pool.render(*pages[0])
+        pool = throughput(page_renderer(render_pool.render), n_pages, threads)
+        render_pool.shutdown()
+        print(f'{"pool " + str(processes) + " proc.":<16}  {pool:>9.1f}')
+        processes *= 2
+
+
+if __name__ == '__main__':
+    n_stations = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    n_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    cores = os.cpu_count()
+    threads = 2 * cores
+
+    print(f'{n_stations} estaciones, {n_pages} páginas, {threads} hilos, '
+          f'{cores} núcleos')
+    run(False, n_stations, n_pages, threads, cores)
+    run(True, n_stations, n_pages, threads, cores)
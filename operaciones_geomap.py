@@ -1,5 +1,8 @@
 # hacer consultas y precesar el resultado json
 import urllib.request, json
+# clasificar los errores de las consultas
+import urllib.error
+import http.client
 # aglutinar datos como dataframes
 import pandas as pd
 import numpy as np
@@ -8,6 +11,107 @@ import plotly.graph_objects as go
 import plotly.express as px
 # para aplicar regular expresions
 import re
+# codificar la superficie de temperaturas como imagen PNG
+import base64
+import struct
+import zlib
+# cachés de respuestas y superficies de temperatura
+from collections import OrderedDict
+import threading
+import time
+# precarga en segundo plano
+from concurrent.futures import ThreadPoolExecutor
+
+
+# usuario para consultar la API
+GEONAMES_USERNAME = 'jmiraal'
+
+# tiempo máximo de espera (segundos) para cada consulta a la API
+REQUEST_TIMEOUT = 10
+
+# códigos de 'status' de GeoNames que indican un problema del servicio y no 
+# de la consulta: autorización (10), error interno (12), timeout de la base 
+# de datos (13), límites de créditos diario, horario y semanal (18, 19, 20), 
+# servidor sobrecargado (22) y servicio no disponible (24)
+SERVICE_STATUS = (10, 12, 13, 18, 19, 20, 22, 24)
+
+
+class GeoNames_Error(Exception):
+    '''
+    Error al consultar 'http://api.geonames.org': la API ha devuelto un 
+    mensaje de error en lugar de datos, o no se ha podido obtener respuesta 
+    y no hay datos anteriores en caché con los que responder.
+    
+    ATTRIBUTES:
+        value (int): Código de 'status' devuelto por la API, o None si el 
+                     error no procede de un mensaje de la API.
+    '''
+    
+    def __init__(self, message, value = None):
+        Exception.__init__(self, message)
+        self.value = value
+
+
+class Circuit_Open_Error(GeoNames_Error):
+    '''
+    La consulta se ha rechazado sin llegar a la API porque el circuit 
+    breaker de ese servicio está abierto.
+    '''
+
+
+def check_status(data, key):
+    '''
+    USAGE: 
+        Comprueba si la respuesta de la API es un mensaje de error (un objeto 
+        'status' en lugar de la clave 'key' con los datos). El código 15 
+        (sin resultados) se trata como una respuesta vacía; el resto se 
+        reporta como GeoNames_Error con el código en 'value'.
+    INPUT
+        data (dict): Diccionario obtenido tras consultar la API.
+        key (String): Clave con los datos esperados ('geonames' o 
+                      'weatherObservations').
+    OUTPUT
+        data (dict): Diccionario con la clave 'key'.
+    '''
+    if 'status' in data and key not in data:
+        status = data['status']
+        if get_element(status, 'value') == 15:
+            return {key: []}
+        raise GeoNames_Error(str(get_element(status, 'message')), 
+                             get_element(status, 'value', 'num'))
+    
+    return data
+
+
+def is_upstream_failure(error):
+    '''
+    USAGE: 
+        Indica si un error al consultar la API se debe al servicio (fallos de 
+        red, timeouts o SSL, respuestas cortadas o ilegibles, errores HTTP 
+        5xx o 429 y códigos de SERVICE_STATUS) y no a la propia consulta (por 
+        ejemplo un 
+        parámetro que falta o no es válido). Sólo los primeros cuentan como 
+        fallos para los circuit breakers y permiten responder con datos 
+        anteriores de la caché.
+    INPUT
+        error (Exception): Error obtenido al consultar la API.
+    OUTPUT
+        upstream (bool): True si el error se debe al servicio.
+    '''
+    if isinstance(error, Circuit_Open_Error):
+        return True
+    if isinstance(error, GeoNames_Error):
+        if error.__cause__ is not None:
+            return is_upstream_failure(error.__cause__)
+        return error.value in SERVICE_STATUS
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code == 429
+    
+    # OSError incluye URLError, timeouts, errores de conexión y de SSL, 
+    # también los que ocurren al leer la respuesta; HTTPException incluye 
+    # las respuestas incompletas (IncompleteRead)
+    return isinstance(error, (OSError, http.client.HTTPException, 
+                              json.JSONDecodeError))
 
 
 def clean_name(name):
@@ -47,9 +151,10 @@ def request_geo(name, username):
                str(username)
     
     # ejecutamos la consulta
-    response = urllib.request.urlopen(url_geo)
+    response = urllib.request.urlopen(url_geo, timeout=REQUEST_TIMEOUT)
     # interpretamos el resultado json y lo reportamos
     data = json.loads(response.read())
+    data = check_status(data, 'geonames')
     
     return data
     
@@ -184,9 +289,10 @@ def request_meteo(bbox, username):
                   "&username=" + username
     
     # ejecutamos la consulta
-    response = urllib.request.urlopen(url_weather)
+    response = urllib.request.urlopen(url_weather, timeout=REQUEST_TIMEOUT)
     # interpretamos el resultado json y lo reportamos
     data = json.loads(response.read())
+    data = check_status(data, 'weatherObservations')
     
     return data
 
@@ -279,8 +385,583 @@ def get_weather_data(data):
     df_meteo = df_meteo.append(new_row, ignore_index=True)
 
     return df_meteo
+
+
+class Response_Cache():
+    '''
+    Caché en memoria para las respuestas de 'http://api.geonames.org'. 
+    Cada entrada caduca pasados 'ttl' segundos y, si se supera 'max_size', 
+    se descartan las entradas más antiguas. Las entradas caducadas se 
+    conservan hasta ser descartadas para poder responder con los últimos 
+    datos conocidos si la API falla. Es segura entre hilos, ya que se 
+    comparte entre las peticiones del servidor y la precarga en segundo 
+    plano.
+    
+    ATTRIBUTES:
+        ttl (int): Segundos que una entrada se considera válida.
+        max_size (int): Número máximo de entradas almacenadas.
+    '''
+    
+    def __init__(self, ttl, max_size = 256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    
+    def get(self, key):
+        '''
+        USAGE: 
+            Devuelve el valor almacenado para 'key' si existe y no ha 
+            caducado. En caso contrario devuelve None.
+        INPUT
+            key: Clave de la entrada.
+        OUTPUT
+            value: Valor almacenado o None.
+        '''
+        with self._lock:
+            if key not in self._data:
+                return None
+            timestamp, value = self._data[key]
+            if time.time() - timestamp > self.ttl:
+                return None
+            self._data.move_to_end(key)
+            return value
     
     
+    def get_stale(self, key):
+        '''
+        USAGE: 
+            Devuelve el último valor almacenado para 'key' aunque haya 
+            caducado, o None si no existe.
+        INPUT
+            key: Clave de la entrada.
+        OUTPUT
+            value: Valor almacenado o None.
+        '''
+        with self._lock:
+            if key not in self._data:
+                return None
+            return self._data[key][1]
+    
+    
+    def set(self, key, value):
+        '''
+        USAGE: 
+            Almacena 'value' para la clave 'key' con la hora actual.
+        INPUT
+            key: Clave de la entrada.
+            value: Valor a almacenar.
+        OUTPUT
+            No devuelve ningún parámetro.
+        '''
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+class Circuit_Breaker():
+    '''
+    Circuit breaker para un servicio de 'http://api.geonames.org'. 
+    Mientras está cerrado ('closed') las consultas se ejecutan normalmente. 
+    Tras 'failure_threshold' errores consecutivos se abre ('open') y rechaza 
+    las consultas inmediatamente con Circuit_Open_Error, sin ocupar al 
+    servidor esperando a la API. Abierto, ejecuta en segundo plano la 
+    consulta de prueba 'probe' cada 'recovery_timeout' segundos 
+    ('half_open' mientras lo hace) y vuelve a cerrarse en cuanto el servicio 
+    responde. Sólo cuentan como errores los que 'is_upstream_failure' 
+    atribuye al servicio; los errores de la propia consulta (GeoNames_Error 
+    con un código que no es de SERVICE_STATUS) demuestran que el servicio 
+    responde. Cualquier otro error no se contabiliza.
+    
+    ATTRIBUTES:
+        name (String): Nombre del servicio, para las métricas.
+        probe (function): Consulta conocida y válida, sin parámetros, con la 
+                          que se comprueba si el servicio se ha recuperado.
+        failure_threshold (int): Errores consecutivos para abrir el circuito.
+        recovery_timeout (float): Segundos entre consultas de prueba.
+        state (String): Estado actual: 'closed', 'open' o 'half_open'.
+    '''
+    
+    def __init__(self, name, probe, failure_threshold = 5, 
+                 recovery_timeout = 30):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = 'closed'
+        self._lock = threading.Lock()
+        # contadores para las métricas
+        self._failures = 0
+        self._total_failures = 0
+        self._total_successes = 0
+        self._rejected = 0
+        self._opened = 0
+        self._last_error = ''
+    
+    
+    def call(self, function, *args):
+        '''
+        USAGE: 
+            Ejecuta function(*args) si el circuito está cerrado y registra su 
+            resultado. Si está abierto lanza Circuit_Open_Error sin 
+            ejecutarla.
+        INPUT
+            function (function): Consulta a ejecutar.
+            args: Parámetros de la consulta.
+        OUTPUT
+            result: Resultado de la consulta.
+        '''
+        with self._lock:
+            if self.state != 'closed':
+                self._rejected += 1
+                raise Circuit_Open_Error('Servicio ' + self.name + 
+                                         ' no disponible')
+        try:
+            result = function(*args)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self._record_failure(e)
+            elif isinstance(e, GeoNames_Error):
+                self._record_success()
+            raise
+        self._record_success()
+        
+        return result
+    
+    
+    def _record_success(self):
+        '''
+        USAGE: 
+            Contabiliza una respuesta del servicio y reinicia los errores 
+            consecutivos.
+        '''
+        with self._lock:
+            self._failures = 0
+            self._total_successes += 1
+    
+    
+    def _record_failure(self, error):
+        '''
+        USAGE: 
+            Contabiliza un error y abre el circuito si se ha alcanzado el 
+            umbral, programando la primera consulta de prueba.
+        '''
+        with self._lock:
+            self._failures += 1
+            self._total_failures += 1
+            self._last_error = repr(error)
+            if self.state == 'closed' and \
+               self._failures >= self.failure_threshold:
+                self.state = 'open'
+                self._opened += 1
+                self._schedule_probe()
+    
+    
+    def _schedule_probe(self):
+        '''
+        USAGE: 
+            Programa una consulta de prueba dentro de 'recovery_timeout' 
+            segundos en un hilo aparte.
+        '''
+        timer = threading.Timer(self.recovery_timeout, self._probe)
+        timer.daemon = True
+        timer.start()
+    
+    
+    def _probe(self):
+        '''
+        USAGE: 
+            Ejecuta la consulta de prueba. Si el servicio responde cierra el 
+            circuito; si no, lo mantiene abierto y programa otra prueba.
+        '''
+        with self._lock:
+            self.state = 'half_open'
+        try:
+            self.probe()
+        except Exception as e:
+            if is_upstream_failure(e) or not isinstance(e, GeoNames_Error):
+                with self._lock:
+                    self.state = 'open'
+                    if is_upstream_failure(e):
+                        self._total_failures += 1
+                    self._last_error = repr(e)
+                    self._schedule_probe()
+                return
+        with self._lock:
+            self.state = 'closed'
+            self._failures = 0
+            self._total_successes += 1
+    
+    
+    def metrics(self):
+        '''
+        USAGE: 
+            Devuelve el estado del circuito y sus contadores.
+        INPUT
+            No recibe ningún parámetro.
+        OUTPUT
+            metrics (dict): Diccionario con el nombre, el estado, los errores 
+                            consecutivos y totales, los éxitos, las consultas 
+                            rechazadas, las veces que se ha abierto y el 
+                            último error.
+        '''
+        with self._lock:
+            return {'name': self.name,
+                    'state': self.state,
+                    'consecutive_failures': self._failures,
+                    'failures': self._total_failures,
+                    'successes': self._total_successes,
+                    'rejected': self._rejected,
+                    'opened': self._opened,
+                    'last_error': self._last_error}
+
+
+# las búsquedas geográficas apenas cambian, mientras que las observaciones 
+# meteorológicas se actualizan aproximadamente cada hora
+geo_cache = Response_Cache(ttl=3600)
+meteo_cache = Response_Cache(ttl=600)
+
+# un circuit breaker por cada servicio de la API. Para comprobar si se han 
+# recuperado se consulta siempre la misma ubicación (Londres).
+geo_breaker = Circuit_Breaker(
+    'searchJSON', 
+    lambda: request_geo('London', GEONAMES_USERNAME))
+meteo_breaker = Circuit_Breaker(
+    'weatherJSON', 
+    lambda: request_meteo([51.7, 51.3, 0.3, -0.5], GEONAMES_USERNAME))
+
+
+def fetch_with_fallback(cache, breaker, key, function, *args):
+    '''
+    USAGE: 
+        Devuelve la respuesta almacenada en 'cache' para 'key' si sigue 
+        siendo válida. Si no, ejecuta la consulta a través de 'breaker' y 
+        guarda el resultado. Si el servicio falla (ver 'is_upstream_failure') 
+        o el circuito está abierto se responde con los últimos datos 
+        conocidos aunque hayan caducado y, si no los hay, se lanza 
+        GeoNames_Error. Los errores de la propia consulta se propagan.
+    INPUT
+        cache (Response_Cache): Caché del servicio.
+        breaker (Circuit_Breaker): Circuit breaker del servicio.
+        key: Clave de la consulta en la caché.
+        function (function): Consulta a la API.
+        args: Parámetros de la consulta.
+    OUTPUT
+        data (dict): Diccionario con la respuesta.
+        stale (bool): True si la respuesta son datos caducados de la caché.
+    '''
+    data = cache.get(key)
+    if data is not None:
+        return data, False
+    try:
+        data = breaker.call(function, *args)
+    except Exception as e:
+        if not is_upstream_failure(e):
+            raise
+        data = cache.get_stale(key)
+        if data is None:
+            if isinstance(e, GeoNames_Error):
+                raise
+            raise GeoNames_Error(repr(e)) from e
+        return data, True
+    cache.set(key, data)
+    
+    return data, False
+
+
+def request_geo_cached(name, username):
+    '''
+    USAGE: 
+        Igual que 'request_geo' pero reutilizando la respuesta almacenada en 
+        'geo_cache' si existe y protegida por 'geo_breaker' (ver 
+        'fetch_with_fallback').
+    INPUT
+        name (String): Nombre de la ciudad o ubicación.
+        username (String): Usuario para la consulta.
+    OUTPUT
+        data (dict): Diccionario con la información de la respuesta.
+        stale (bool): True si son datos caducados de la caché.
+    '''
+    return fetch_with_fallback(geo_cache, geo_breaker, (name, username), 
+                               request_geo, name, username)
+
+
+def request_meteo_cached(bbox, username):
+    '''
+    USAGE: 
+        Igual que 'request_meteo' pero reutilizando la respuesta almacenada en 
+        'meteo_cache' si existe y protegida por 'meteo_breaker' (ver 
+        'fetch_with_fallback'). Si la caja se está precargando en segundo 
+        plano se espera a esa descarga en lugar de repetir la consulta.
+    INPUT
+        bbox (list): Lista con cuatro coordenadas [north, south, east, west].
+        username (String): Usuario para la consulta.
+    OUTPUT
+        data (dict): Diccionario con la información de las estaciones 
+                     meteorológicas contenidas dentro de la caja.
+        stale (bool): True si son datos caducados de la caché.
+    '''
+    wait_prefetch(bbox, username)
+    
+    return fetch_with_fallback(meteo_cache, meteo_breaker, 
+                               (tuple(bbox), username), 
+                               request_meteo, bbox, username)
+
+
+def get_bbox(df_data_geo, elemento):
+    '''
+    USAGE: 
+        Obtiene la caja de coordenadas de la localización de la fila 
+        'elemento' de df_data_geo en el formato que espera 'request_meteo'. 
+        Si la localización no tiene caja se usa una por defecto para que de 
+        todos modos se muestre el mapa.
+    INPUT
+        df_data_geo (DataFrame): Dataframe con información geográfica generado 
+                                 en 'get_geographical_data'.
+        elemento (int): Fila de la localización.
+    OUTPUT
+        bbox (list): Lista con cuatro coordenadas [north, south, east, west].
+    '''
+    bbox_geo = df_data_geo.iloc[elemento]['bbox']
+    if bbox_geo != '':
+        bbox = [bbox_geo['north'], bbox_geo['south'], 
+                bbox_geo['east'], bbox_geo['west']]
+    else:
+        bbox = [0, 0, 0, 0]
+    
+    return bbox
+
+
+# número de localizaciones alternativas cuyos datos meteorológicos 
+# precargamos y número máximo de precargas pendientes. La precarga se hace 
+# con un único hilo para no competir con las peticiones de los usuarios. 
+# '_prefetch_pending' guarda el Future de cada caja pendiente.
+PREFETCH_CANDIDATES = 3
+PREFETCH_MAX_PENDING = 12
+_prefetch_executor = ThreadPoolExecutor(max_workers=1, 
+                                        thread_name_prefix='prefetch')
+_prefetch_pending = {}
+_prefetch_lock = threading.Lock()
+
+
+def _prefetch_worker(bbox, username):
+    '''
+    USAGE: 
+        Descarga en segundo plano los datos meteorológicos de 'bbox' y los 
+        guarda en 'meteo_cache'. Los errores se ignoran: si la precarga 
+        falla, la petición del usuario volverá a consultar la API.
+    '''
+    try:
+        fetch_with_fallback(meteo_cache, meteo_breaker, 
+                            (tuple(bbox), username), 
+                            request_meteo, bbox, username)
+    except Exception:
+        pass
+    finally:
+        with _prefetch_lock:
+            _prefetch_pending.pop((tuple(bbox), username), None)
+
+
+def wait_prefetch(bbox, username):
+    '''
+    USAGE: 
+        Si la caja 'bbox' tiene una precarga pendiente, evita que la petición 
+        del usuario consulte la API por segunda vez: si la precarga aún no ha 
+        empezado se cancela (la petición hará la consulta) y si ya está en 
+        marcha se espera a que termine, como mucho REQUEST_TIMEOUT segundos.
+    INPUT
+        bbox (list): Lista con cuatro coordenadas [north, south, east, west].
+        username (String): Usuario para la consulta.
+    OUTPUT
+        No devuelve ningún parámetro.
+    '''
+    key = (tuple(bbox), username)
+    with _prefetch_lock:
+        future = _prefetch_pending.get(key)
+    if future is None:
+        return
+    if future.cancel():
+        with _prefetch_lock:
+            if _prefetch_pending.get(key) is future:
+                del _prefetch_pending[key]
+        return
+    try:
+        future.result(timeout=REQUEST_TIMEOUT)
+    except Exception:
+        pass
+
+
+def prefetch_meteo(df_data_geo, elemento, username, 
+                   n_candidates = PREFETCH_CANDIDATES):
+    '''
+    USAGE: 
+        Programa en segundo plano la descarga de los datos meteorológicos de 
+        las 'n_candidates' localizaciones siguientes a 'elemento' en 
+        df_data_geo (al llegar a la última se continúa por la primera), de 
+        forma que si el usuario elige otra de ellas la respuesta sea 
+        inmediata. Se omiten las localizaciones sin caja de coordenadas. No 
+        se programan las cajas que ya estén en caché o pendientes, ni más de 
+        PREFETCH_MAX_PENDING a la vez. Si el circuito del servicio 
+        meteorológico está abierto no se precarga nada.
+    INPUT
+        df_data_geo (DataFrame): Dataframe con información geográfica generado 
+                                 en 'get_geographical_data'.
+        elemento (int): Fila de la localización que ya se ha servido.
+        username (String): Usuario para la consulta.
+        n_candidates (int): Número de localizaciones a precargar.
+    OUTPUT
+        No devuelve ningún parámetro.
+    '''
+    if meteo_breaker.state != 'closed':
+        return
+    n_rows = df_data_geo.shape[0]
+    candidates = [(elemento + step) % n_rows for step in range(1, n_rows)]
+    candidates = [i for i in candidates if df_data_geo.iloc[i]['bbox'] != '']
+    for i in candidates[:n_candidates]:
+        bbox = get_bbox(df_data_geo, i)
+        key = (tuple(bbox), username)
+        if meteo_cache.get(key) is not None:
+            continue
+        with _prefetch_lock:
+            if key in _prefetch_pending or \
+               len(_prefetch_pending) >= PREFETCH_MAX_PENDING:
+                continue
+            _prefetch_pending[key] = _prefetch_executor.submit(
+                _prefetch_worker, bbox, username)
+
+
+def get_observation_version(df_data_meteo):
+    '''
+    USAGE:
+        Calcula la versión de las observaciones contenidas en df_data_meteo:
+        una tupla con la fecha, el nombre, la temperatura y la posición de
+        cada estación. Cambiará en cuanto GeoNames reporte una observación
+        nueva para alguna estación. Se utiliza como parte de la clave de la
+        caché de superficies de temperatura, por lo que los valores que
+        faltan (NaN) se sustituyen por None: cada NaN es un objeto distinto
+        y no se compara igual a sí mismo, lo que impediría encontrar la clave.
+    INPUT
+        df_data_meteo (DataFrame): Dataframe con información meteorológica
+                                   generado en 'get_weather_data'.
+    OUTPUT
+        version (tuple): Versión de las observaciones.
+    '''
+    # excluimos la última fila, que contiene la media de las estaciones
+    df_aux = df_data_meteo.iloc[:-1]
+    version = tuple(tuple(None if pd.isnull(value) else value
+                          for value in row)
+                    for row in zip(df_aux['datetime'],
+                                   df_aux['stationName'],
+                                   df_aux['temperature'],
+                                   df_aux['lat'],
+                                   df_aux['lng']))
+
+    return version
+
+
+# caché de superficies de temperatura interpoladas, indexada por
+# (bbox, versión de las observaciones, puntos de la malla, potencia).
+# Se descartan las entradas más antiguas al superar SURFACE_CACHE_SIZE. Se
+# comparte entre los hilos del servidor, así que se accede con el lock.
+SURFACE_CACHE_SIZE = 64
+_surface_cache = OrderedDict()
+_surface_cache_lock = threading.Lock()
+
+# número máximo de distancias (puntos de malla x estaciones) que calculamos
+# de una vez para acotar la memoria al interpolar con muchas estaciones
+_IDW_BLOCK_SIZE = 2 ** 21
+
+
+def interpolate_temperature(lat_est, lng_est, temp_est, bbox,
+                            n_points = 200, power = 2, version = None):
+    '''
+    USAGE:
+        Interpola una superficie de temperaturas sobre la caja de coordenadas
+        'bbox' a partir de las observaciones de las estaciones, utilizando
+        ponderación por el inverso de la distancia (IDW). La malla tendrá
+        n_points x n_points puntos. El cálculo está vectorizado con numpy y
+        se hace por bloques de filas de la malla para acotar la memoria.
+        Si se indica 'version' el resultado se guarda en caché indexado por
+        (bbox, version, n_points, power), de forma que consultas repetidas
+        sobre las mismas observaciones no vuelven a interpolar.
+        Las estaciones sin temperatura o sin coordenadas se descartan.
+    INPUT
+        lat_est (list): Lista de latitudes de las estaciones.
+        lng_est (list): Lista de longitudes de las estaciones.
+        temp_est (list): Lista de temperaturas de las estaciones.
+        bbox (list): Lista con cuatro coordenadas [north, south, east, west].
+        n_points (int): Número de puntos de la malla en cada eje.
+        power (float): Exponente de la distancia en la ponderación.
+        version (tuple): Versión de las observaciones (ver 
+                         'get_observation_version'). Si es None no se usa 
+                         la caché.
+    OUTPUT
+        lats (numpy.ndarray): Latitudes de la malla (n_points).
+        lngs (numpy.ndarray): Longitudes de la malla (n_points).
+        temp_grid (numpy.ndarray): Temperaturas interpoladas
+                                   (n_points x n_points), filas por latitud.
+                                   Todo NaN si no hay estaciones válidas.
+    '''
+    key = (tuple(float(x) for x in bbox), version, n_points, power)
+    if version is not None:
+        with _surface_cache_lock:
+            if key in _surface_cache:
+                _surface_cache.move_to_end(key)
+                return _surface_cache[key]
+
+    north, south, east, west = [float(x) for x in bbox]
+    lats = np.linspace(south, north, n_points)
+    lngs = np.linspace(west, east, n_points)
+
+    # convertimos las observaciones a arrays y descartamos las incompletas
+    lat_est = pd.to_numeric(pd.Series(lat_est), errors='coerce').values
+    lng_est = pd.to_numeric(pd.Series(lng_est), errors='coerce').values
+    temp_est = pd.to_numeric(pd.Series(temp_est), errors='coerce').values
+    valid = ~(np.isnan(lat_est) | np.isnan(lng_est) | np.isnan(temp_est))
+    lat_est = lat_est[valid]
+    lng_est = lng_est[valid]
+    temp_est = temp_est[valid]
+
+    temp_grid = np.full((n_points, n_points), np.nan)
+    if temp_est.size > 0:
+        # corregimos las longitudes por el coseno de la latitud media para
+        # que las distancias sean aproximadamente isótropas
+        cos_lat = np.cos(np.radians((north + south) / 2))
+        lng_grid_scaled = lngs * cos_lat
+        lng_est_scaled = lng_est * cos_lat
+
+        # filas de la malla que procesamos en cada bloque
+        rows_block = max(1, _IDW_BLOCK_SIZE // (n_points * temp_est.size))
+        for start in range(0, n_points, rows_block):
+            lat_block = lats[start:start + rows_block]
+            # distancias al cuadrado con forma (filas, columnas, estaciones)
+            dist2 = (lat_block[:, None, None] - lat_est[None, None, :]) ** 2 + \
+                    (lng_grid_scaled[None, :, None] -
+                     lng_est_scaled[None, None, :]) ** 2
+            # evitamos dividir por cero si un punto coincide con una estación
+            np.maximum(dist2, 1e-12, out=dist2)
+            weights = dist2 ** (-power / 2)
+            temp_grid[start:start + rows_block] = \
+                (weights @ temp_est) / weights.sum(axis=2)
+
+    # los resultados se comparten a través de la caché, así que los
+    # marcamos como de sólo lectura
+    for array in (lats, lngs, temp_grid):
+        array.setflags(write=False)
+    result = (lats, lngs, temp_grid)
+
+    if version is not None:
+        with _surface_cache_lock:
+            _surface_cache[key] = result
+            while len(_surface_cache) > SURFACE_CACHE_SIZE:
+                _surface_cache.popitem(last=False)
+
+    return result
+
+
 class Figure_Custom(go.Figure):
     ''' 
     Extensión de la clase plotly.graph_objects.Figure a la que se añade una
@@ -484,7 +1165,91 @@ def add_markers(fig, lat_list, long_list, text_list, size, color):
     )
     
     
-def draw_weather_map(df_data_geo, df_data_meteo, elemento):
+def temperature_to_png(temp_grid, zmin = -15, zmax = 45):
+    '''
+    USAGE: 
+        Convierte una malla de temperaturas en una imagen PNG codificada como 
+        data URL. Cada celda se colorea interpolando la escala RdYlBu_r entre 
+        'zmin' y 'zmax', la misma que utiliza el termómetro. Las celdas sin 
+        valor quedan transparentes. La primera fila de la malla (la latitud 
+        más baja) queda en la parte inferior de la imagen.
+    INPUT
+        temp_grid (numpy.ndarray): Temperaturas con una fila por latitud 
+                                   (de sur a norte) y una columna por 
+                                   longitud (de oeste a este).
+        zmin (float): Temperatura correspondiente al primer color.
+        zmax (float): Temperatura correspondiente al último color.
+    OUTPUT
+        png_url (String): Imagen PNG como 'data:image/png;base64,...'.
+    '''
+    colors, _ = px.colors.convert_colors_to_same_type(
+        list(px.colors.diverging.RdYlBu_r), colortype='tuple')
+    colors = np.array(colors) * 255
+    positions = np.linspace(zmin, zmax, len(colors))
+    
+    # invertimos las filas para que el norte quede arriba en la imagen
+    temp_image = temp_grid[::-1]
+    valid = ~np.isnan(temp_image)
+    values = np.clip(np.where(valid, temp_image, zmin), zmin, zmax)
+    rgba = np.empty(temp_image.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(values, positions, colors[:, channel])
+    rgba[..., 3] = np.where(valid, 255, 0)
+    
+    # codificamos el PNG: cada fila va precedida del tipo de filtro (0)
+    height, width = temp_image.shape
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+    
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+               struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+    
+    png = b'\x89PNG\r\n\x1a\n' + \
+          chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) + \
+          chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + \
+          chunk(b'IEND', b'')
+    
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+
+
+def add_temperature_surface(fig, lats, lngs, temp_grid):
+    '''
+    USAGE: 
+        Añade a la figura 'fig' una capa de imagen de mapbox con la superficie 
+        de temperaturas interpolada en 'interpolate_temperature'. La imagen 
+        (ver 'temperature_to_png') se ajusta a las esquinas de la malla y se 
+        dibuja por debajo de los marcadores. Al enviarse como un único PNG, 
+        el tamaño de la figura apenas depende de la resolución de la malla.
+    INPUT
+        fig (plotly.graph_objects.Figure): Figura sobre la que queremos 
+                                           representar la superficie.
+        lats (numpy.ndarray): Latitudes de la malla.
+        lngs (numpy.ndarray): Longitudes de la malla.
+        temp_grid (numpy.ndarray): Temperaturas interpoladas, con una fila 
+                                   por latitud y una columna por longitud.
+    OUTPUT
+        No devuelve ningún parámetro.
+    '''
+    north, south = float(lats[-1]), float(lats[0])
+    east, west = float(lngs[-1]), float(lngs[0])
+    
+    fig.update_layout(
+        mapbox_layers=[{
+            'sourcetype': 'image',
+            'source': temperature_to_png(temp_grid),
+            # esquinas: superior izquierda, superior derecha, 
+            # inferior derecha e inferior izquierda
+            'coordinates': [[west, north], [east, north], 
+                            [east, south], [west, south]],
+            'opacity': 0.5,
+            'below': 'traces'
+        }]
+    )
+
+
+def draw_weather_map(df_data_geo, df_data_meteo, elemento, 
+                     temp_surface = False):
     '''
     USAGE: 
         Genera una figura en plotly centrada en la localización almacenada 
@@ -499,11 +1264,17 @@ def draw_weather_map(df_data_geo, df_data_meteo, elemento):
         por la temperatura media. Junto a este nivel se representa también una 
         anotación con los valores medios de temperatura, humedad y velocidad del 
         viento.
+        Si se indica 'temp_surface' se añade por debajo de los marcadores una 
+        superficie de temperaturas interpolada a partir de las estaciones sobre 
+        la caja de coordenadas de la localización.
     INPUT
         df_geo_data (DataFrame): Dataframe con información geográfica generado 
                                  en 'get_geographical_data'. 
         df_data_meteo (DataFrame): Dataframe con información meteorológica 
                                    generado en 'get_weather_data'.
+        elemento (int): Fila de df_geo_data con la localización a representar.
+        temp_surface (bool): Si es True se representa la superficie de 
+                             temperaturas interpolada.
     OUTPUT
         fig (plotly.graph_objects.Figure): Figura con la composición explicada 
                                            en 'USAGE' lista para ser mostrada.
@@ -540,6 +1311,17 @@ def draw_weather_map(df_data_geo, df_data_meteo, elemento):
                  '<br>Humedad: ' + str(humidity[-1]) + ' %' + \
                  '<br>Viento: ' + str(windspeed[-1]) + ' knots'
         fig.draw_termometer(temperature[-1], text_info)
+    
+    # si se ha pedido, añadimos la superficie de temperaturas como una capa 
+    # de imagen por debajo de los marcadores. Necesitamos que la 
+    # localización tenga caja de coordenadas y que haya alguna estación.
+    if temp_surface and df_data_geo.iloc[elemento]['bbox'] != '' and \
+       df_data_meteo.shape[0] > 1:
+        bbox = get_bbox(df_data_geo, elemento)
+        lats, lngs, temp_grid = interpolate_temperature(
+            lat_est[:-1], lng_est[:-1], temperature[:-1], bbox, 
+            version=get_observation_version(df_data_meteo))
+        add_temperature_surface(fig, lats, lngs, temp_grid)
         
     
     # añadimos una capa Scattermapbox a la figura con el marcador 
@@ -593,6 +1375,59 @@ def draw_weather_map(df_data_geo, df_data_meteo, elemento):
         showlegend=False
     )
     return fig
+
+
+def build_results(df_data_geo, df_data_meteo, elemento, temp_surface = False):
+    '''
+    USAGE: 
+        Genera el contenido de la página de resultados: el mapa de 
+        'draw_weather_map' codificado en JSON para plotly.js y la tabla html 
+        de estaciones, sin la última fila con la media ni las columnas de 
+        coordenadas. Si no hay estaciones la tabla es un mensaje indicándolo.
+        Es la parte de la petición que más CPU consume, por lo que puede 
+        ejecutarse en un proceso aparte (ver 'operaciones_render').
+    INPUT
+        df_data_geo (DataFrame): Dataframe con información geográfica generado 
+                                 en 'get_geographical_data'.
+        df_data_meteo (DataFrame): Dataframe con información meteorológica 
+                                   generado en 'get_weather_data'.
+        elemento (int): Fila de df_geo_data con la localización a representar.
+        temp_surface (bool): Si es True se representa la superficie de 
+                             temperaturas interpolada.
+    OUTPUT
+        results (dict): Diccionario con las claves:
+            - 'ids': Identificadores de los gráficos en la página.
+            - 'graphJSON': Gráficos codificados en JSON.
+            - 'tables': Lista con la tabla html de estaciones.
+            - 'titles': Nombres de las columnas de la tabla.
+    '''
+    # representar el mapa y codificarlo en JSON. 'to_json' ya utiliza 
+    # PlotlyJSONEncoder, así que basta con componer la lista de gráficos
+    fig = draw_weather_map(df_data_geo, df_data_meteo, elemento, temp_surface)
+    ids = ["graph-0"]
+    graphJSON = '[' + fig.to_json() + ']'
+    
+    # si existe estacioens preparamos la tabla de estaciones para 
+    # ser mostrada también eliminamos la últim fila con la media y las 
+    # dos últimas columnas con las coordenadas
+    titles = list(df_data_meteo.columns.values)
+    if df_data_meteo.shape[0] > 1:
+        titles = ['Date', 'Name', 'Temp.', 'Humid.', 
+                  'Wind', 'Clouds', 'lat', 'lng']
+        df_table = df_data_meteo.iloc[:-1,:-2].copy()
+        df_table.columns = titles[:-2]
+        table_html = df_table.to_html(classes='data', index = False)
+        table_html = table_html.replace('table', 'table align="center"')
+        
+    else:
+        # si no hay estacioenes mostramos un mensaje indicándolo
+        table_html = '<h4 class="text-center">No se ha encontrado ninguna \
+                                    estación.</h4>'
+    
+    return {'ids': ids, 
+            'graphJSON': graphJSON, 
+            'tables': [table_html], 
+            'titles': titles}
     
     
     
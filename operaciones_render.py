@@ -0,0 +1,257 @@
+# ejecutar el renderizado en un pool de procesos
+import os
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+# renderizar las plantillas fuera de Flask
+import jinja2
+# construcción de la figura y la tabla
+from operaciones_geomap import *
+
+
+# configuración del pool de procesos mediante variables de entorno:
+#   - METEOMAP_RENDER_PROCESSES: número de procesos. Con 0 (por defecto) el
+#     renderizado se hace en el propio hilo de la petición.
+#   - METEOMAP_RENDER_MAX_PENDING: número máximo de páginas en cola o en
+#     proceso. Por defecto el doble del número de procesos.
+#   - METEOMAP_RENDER_QUEUE_TIMEOUT: segundos que una petición espera a que
+#     haya hueco en la cola antes de rechazarse.
+#   - METEOMAP_RENDER_TIMEOUT: segundos que una petición espera a que su
+#     página se genere antes de rechazarse.
+RENDER_PROCESSES = int(os.environ.get('METEOMAP_RENDER_PROCESSES', 0))
+RENDER_MAX_PENDING = int(os.environ.get('METEOMAP_RENDER_MAX_PENDING',
+                                        2 * RENDER_PROCESSES))
+RENDER_QUEUE_TIMEOUT = float(os.environ.get('METEOMAP_RENDER_QUEUE_TIMEOUT',
+                                            5))
+RENDER_TIMEOUT = float(os.environ.get('METEOMAP_RENDER_TIMEOUT', 30))
+
+# segundos que se espera, al crear el pool, a que los procesos arranquen
+WARM_UP_TIMEOUT = 60
+
+# carpeta con las plantillas de la aplicación
+TEMPLATES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'webapp', 'templates')
+_jinja_env = None
+
+
+class Render_Pool_Busy(Exception):
+    '''
+    La cola del pool de renderizado está llena y no ha quedado hueco libre
+    en el tiempo de espera indicado, o la página no se ha generado a tiempo.
+    '''
+
+
+def get_jinja_env():
+    '''
+    USAGE:
+        Devuelve el entorno jinja2 con las plantillas de la aplicación,
+        configurado como el de Flask (autoescape en las plantillas html).
+        Se crea una sola vez por proceso.
+    INPUT
+        No recibe ningún parámetro.
+    OUTPUT
+        env (jinja2.Environment): Entorno de plantillas.
+    '''
+    global _jinja_env
+    if _jinja_env is None:
+        _jinja_env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATES_FOLDER),
+            autoescape=jinja2.select_autoescape(['html']))
+
+    return _jinja_env
+
+
+def render_go_page(geo_row, meteo_columns, temp_surface, template_args):
+    '''
+    USAGE:
+        Genera la página go.html completa a partir de datos compactos y la
+        devuelve codificada lista para enviar. Es la función que se ejecuta
+        en los procesos del pool, por lo que sólo recibe tipos básicos: la
+        fila de la localización elegida y las columnas de las estaciones.
+    INPUT
+        geo_row (dict): Fila de df_data_geo con la localización a representar.
+        meteo_columns (dict): Columnas de df_data_meteo como listas
+                              (DataFrame.to_dict('list')).
+        temp_surface (bool): Si es True se representa la superficie de
+                             temperaturas interpolada.
+        template_args (dict): Resto de parámetros de la plantilla go.html.
+    OUTPUT
+        page (bytes): Página html codificada en UTF-8.
+    '''
+    df_data_geo = pd.DataFrame([geo_row])
+    df_data_meteo = pd.DataFrame(meteo_columns)
+    results = build_results(df_data_geo, df_data_meteo, 0, temp_surface)
+    page = get_jinja_env().get_template('go.html').render(**results,
+                                                         **template_args)
+
+    return page.encode('utf-8')
+
+
+def _warm_up(barrier):
+    '''
+    USAGE:
+        Inicializa cada proceso del pool: genera una figura de prueba para
+        que plotly cargue sus módulos y validadores antes de la primera
+        petición real, y espera en 'barrier' a que el resto de procesos y el
+        proceso que crea el pool estén listos.
+    '''
+    geo_row = {'asciiName': '', 'adminName1': '', 'countryName': '',
+               'bbox': {'north': 1, 'south': 0, 'east': 1, 'west': 0},
+               'score': 0, 'lat': 0.5, 'lng': 0.5, 'wiki_link': ''}
+    meteo_columns = {'datetime': ['', ''], 'stationName': ['', ''],
+                     'temperature': [10.0, 10.0], 'humidity': [50.0, 50.0],
+                     'windSpeed': [5.0, 5.0], 'clouds': ['', ''],
+                     'lat': [0.5, ''], 'lng': [0.5, '']}
+    build_results(pd.DataFrame([geo_row]), pd.DataFrame(meteo_columns), 0,
+                  temp_surface=True)
+    try:
+        barrier.wait(timeout=WARM_UP_TIMEOUT)
+    except threading.BrokenBarrierError:
+        pass
+
+
+class Render_Pool():
+    '''
+    Pool de procesos para generar las páginas de resultados fuera del
+    proceso del servidor, de forma que la construcción de la figura y la
+    serialización no bloqueen (GIL) al resto de hilos de la petición.
+    Al crear el pool se espera a que todos sus procesos hayan arrancado y
+    se hayan inicializado. Como mecanismo de contrapresión, no se admiten
+    más de 'max_pending' páginas a la vez (una página ocupa su hueco hasta
+    que su proceso termina): las peticiones que no encuentran hueco en
+    'queue_timeout' segundos, o cuya página no está lista en
+    'render_timeout' segundos, reciben Render_Pool_Busy.
+
+    ATTRIBUTES:
+        processes (int): Número de procesos del pool.
+        max_pending (int): Número máximo de páginas en cola o en proceso.
+        queue_timeout (float): Segundos de espera por un hueco en la cola.
+        render_timeout (float): Segundos de espera por la página generada.
+    '''
+
+    def __init__(self, processes, max_pending = None, queue_timeout = 5,
+                 render_timeout = 30):
+        self.processes = processes
+        self.max_pending = max_pending or 2 * processes
+        self.queue_timeout = queue_timeout
+        self.render_timeout = render_timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+
+    def _start(self):
+        '''
+        USAGE:
+            Crea el ProcessPoolExecutor y espera a que todos sus procesos
+            estén inicializados. Los procesos se arrancan bajo demanda, así
+            que enviamos una tarea vacía por proceso. Se usa 'spawn' porque
+            el servidor tiene hilos en marcha y 'fork' no es seguro en ese
+            caso.
+        '''
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(self.processes + 1)
+        executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=context,
+            initializer=_warm_up,
+            initargs=(barrier,))
+        for i in range(self.processes):
+            executor.submit(int)
+        try:
+            barrier.wait(timeout=WARM_UP_TIMEOUT)
+        except threading.BrokenBarrierError:
+            pass
+
+        return executor
+
+
+    def _restart(self, executor):
+        '''
+        USAGE:
+            Sustituye 'executor' por un pool nuevo si nadie lo ha hecho ya.
+        '''
+        with self._lock:
+            if self._executor is executor:
+                executor.shutdown(wait=False)
+                self._executor = self._start()
+
+
+    def render(self, geo_row, meteo_columns, temp_surface, template_args):
+        '''
+        USAGE:
+            Genera la página go.html en uno de los procesos del pool (ver
+            'render_go_page') y espera al resultado como mucho
+            'render_timeout' segundos. Si el pool se ha roto (un proceso ha
+            muerto) se vuelve a crear y la página se genera en el proceso
+            actual.
+        INPUT
+            Los mismos parámetros que 'render_go_page'.
+        OUTPUT
+            page (bytes): Página html codificada en UTF-8.
+        '''
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise Render_Pool_Busy('Cola de renderizado llena')
+        executor = self._executor
+        try:
+            future = executor.submit(render_go_page, geo_row, meteo_columns,
+                                     temp_surface, template_args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._restart(executor)
+            return render_go_page(geo_row, meteo_columns, temp_surface,
+                                  template_args)
+        # el hueco se libera cuando el proceso termina la página, aunque la
+        # petición haya dejado de esperarla
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            return future.result(timeout=self.render_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise Render_Pool_Busy('Tiempo de renderizado agotado')
+        except BrokenProcessPool:
+            self._restart(executor)
+            return render_go_page(geo_row, meteo_columns, temp_surface,
+                                  template_args)
+
+
+    def shutdown(self):
+        '''
+        USAGE:
+            Detiene los procesos del pool.
+        '''
+        self._executor.shutdown()
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    '''
+    USAGE:
+        Devuelve el pool de renderizado configurado con las variables de
+        entorno, creándolo en la primera llamada. Se llama al cargar la
+        aplicación (ver webapp/__init__.py) para que el pool esté arrancado
+        antes de la primera petición; con gunicorn esto ocurre en cada
+        worker, siempre que no se use --preload. Devuelve None si
+        RENDER_PROCESSES es 0 o si se llama desde un proceso del propio
+        pool.
+    INPUT
+        No recibe ningún parámetro.
+    OUTPUT
+        render_pool (Render_Pool): Pool de renderizado o None.
+    '''
+    global _render_pool
+    if RENDER_PROCESSES <= 0 or multiprocessing.parent_process() is not None:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = Render_Pool(RENDER_PROCESSES,
+                                       RENDER_MAX_PENDING or None,
+                                       RENDER_QUEUE_TIMEOUT,
+                                       RENDER_TIMEOUT)
+
+    return _render_pool
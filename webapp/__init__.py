@@ -3,3 +3,8 @@ from flask import Flask
 app = Flask(__name__)
 
 from webapp import routes
+
+# arrancamos el pool de renderizado (si está configurado) al cargar la 
+# aplicación, para que esté listo antes de la primera petición
+from operaciones_render import get_render_pool
+get_render_pool()
@@ -1,6 +1,6 @@
 # import Flask to render web app
 from flask import Flask
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, Response
 
 from datetime import datetime
 
@@ -8,7 +8,7 @@ from datetime import datetime
 import sys
 sys.path.insert(1, './')
 from operaciones_geomap import *
-import plotly
+from operaciones_render import get_render_pool, Render_Pool_Busy
 
 from webapp import app
 #app = Flask(__name__)
@@ -35,6 +35,42 @@ def index():
     return render_template('master.html')
 
 
+def error_page(error):
+    '''
+    USAGE 
+           Página que se muestra cuando la consulta a GeoNames falla. Si el 
+           error es de la propia consulta (por ejemplo un nombre vacío) se 
+           indica que no se ha encontrado ninguna localización. Si GeoNames 
+           no responde y no hay datos anteriores en caché se muestra la 
+           página de servicio no disponible.
+    INPUT
+           error (GeoNames_Error): Error obtenido al consultar la API.
+    OUTPUT
+           Página void.html con el mensaje correspondiente, con código 503 
+           si el servicio no está disponible.
+    '''
+    if not is_upstream_failure(error):
+        return render_template('void.html', 
+                            message='No se ha encontrado ninguna localización.')
+    
+    app.logger.warning('%s %s GEONAMES NO DISPONIBLE\n%s',
+                       request.remote_addr,
+                       request.full_path,
+                       error)
+    
+    return render_template('void.html', 
+                           message='El servicio GeoNames no está disponible ' +
+                                   'en este momento. Inténtelo más tarde.'), 503
+
+
+# métricas de los circuit breakers de la API
+@app.route('/metrics')
+def metrics():
+    
+    return jsonify({'breakers': [geo_breaker.metrics(), 
+                                 meteo_breaker.metrics()]})
+
+
 # cargamos la página con resultados
 @app.route('/go')
 def go():
@@ -48,7 +84,7 @@ def go():
            página void.html                 
     '''
     # usuario para consultar la API
-    user_name = 'jmiraal'
+    user_name = GEONAMES_USERNAME
 
     # nombre de la ciudad
     city_name = request.args.get('query', '') 
@@ -56,60 +92,73 @@ def go():
     # limpiamos el nombre
     city_name = clean_name(city_name)
     
+    # si se ha marcado, representamos la superficie de temperaturas
+    temp_surface = request.args.get('surface', '') != ''
+    
+    # localización elegida entre las encontradas, por defecto la primera
+    try:
+        elemento = int(request.args.get('candidate', 0))
+    except ValueError:
+        elemento = 0
+    
     # cambiamos espacios por '%20' par la query
     city_name_search = re.sub(' ', '%20', city_name)
     
     # obtener datos geográficos 
-    data_geo = request_geo(city_name_search, user_name)
+    try:
+        data_geo, geo_stale = request_geo_cached(city_name_search, user_name)
+    except GeoNames_Error as e:
+        return error_page(e)
     df_data_geo = get_geographical_data(data_geo)
-    # si hemos obtenido alguna localización nos quedamos con la primera
-    elemento = 0
+    # si la localización pedida no existe nos quedamos con la primera
+    if elemento < 0 or elemento >= df_data_geo.shape[0]:
+        elemento = 0
     if df_data_geo.shape[0] > 0:
-        # si la primera localización tiene caja de coordenadas
-        if df_data_geo.iloc[elemento]['bbox'] != '':
-            # definimos un recuadro de coordenadas para 
-            # la búsqueda de estaciones
-            east = df_data_geo.iloc[elemento]['bbox']['east']
-            south = df_data_geo.iloc[elemento]['bbox']['south']
-            north = df_data_geo.iloc[elemento]['bbox']['north']
-            west = df_data_geo.iloc[elemento]['bbox']['west']
-
-            bbox =[north, south, east, west]
-        else:
-            # si no tiene caja de coordenadas usamos una por defecto
-            # para que de todos modos se muestre el mapa
-            bbox =[0, 0, 0, 0]
+        # definimos un recuadro de coordenadas para 
+        # la búsqueda de estaciones
+        bbox = get_bbox(df_data_geo, elemento)
             
         # obetener datos meteorológicos de las estaciones
-        data_meteo = request_meteo(bbox, user_name)
+        try:
+            data_meteo, meteo_stale = request_meteo_cached(bbox, user_name)
+        except GeoNames_Error as e:
+            return error_page(e)
         df_data_meteo = get_weather_data(data_meteo)
 
-        # representar el mapa
-        fig = draw_weather_map(df_data_geo, df_data_meteo, elemento)
+        # lista de localizaciones encontradas para poder elegir otra
+        candidates = [{'index': i,
+                       'name': row['asciiName'] + ' (' + 
+                               str(row['adminName1']) + '/' + 
+                               str(row['countryName']) + ')'}
+                      for i, (index, row) in 
+                      enumerate(df_data_geo.iterrows())]
+        template_args = {'city_name': city_name,
+                         'wiki_link': df_data_geo.iloc[elemento]['wiki_link'],
+                         'candidates': candidates,
+                         'elemento': elemento,
+                         'temp_surface': temp_surface,
+                         'degraded': geo_stale or meteo_stale}
         
-        graphs_str = fig.to_json()
-        graphs_str = '[' + graphs_str + ']'
-        graphs = json.loads(graphs_str)
-    
-        # codificamos el gráfico plotly en JSON
-        ids = ["graph-0"]
-        graphJSON = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
-       
-        # si existe estacioens preparamos la tabla de estaciones para 
-        # ser mostrada también eliminamos la últim fila con la media y las 
-        # dos últimas columnas con las coordenadas
-        if df_data_meteo.shape[0] > 1:
-            columns_list = ['Date', 'Name', 'Temp.', 'Humid.', 
-                            'Wind', 'Clouds', 'lat', 'lng']
-            df_data_meteo.columns = columns_list
-            table_html = df_data_meteo.iloc[:-1,:-2].to_html(classes='data', 
-                                                             index = False)
-            table_html = table_html.replace('table', 'table align="center"')
-            
+        render_pool = get_render_pool()
+        if render_pool is not None:
+            # generamos la página en el pool de procesos, enviándole sólo la 
+            # localización elegida y las columnas de las estaciones
+            try:
+                html = render_pool.render(
+                    df_data_geo.iloc[elemento].to_dict(), 
+                    df_data_meteo.to_dict('list'), 
+                    temp_surface, template_args)
+            except Render_Pool_Busy:
+                return render_template('void.html', 
+                            message='El servidor está ocupado. ' +
+                                    'Inténtelo de nuevo en unos segundos.'), 503
+            html = Response(html, mimetype='text/html')
         else:
-            # si no hay estacioenes mostramos un mensaje indicándolo
-            table_html = '<h4 class="text-center">No se ha encontrado ninguna \
-                                    estación.</h4>'
+            # representamos el mapa y la tabla de estaciones y mostramos la 
+            # página go.html con los resultados de la búsqueda
+            results = build_results(df_data_geo, df_data_meteo, elemento, 
+                                    temp_surface)
+            html = render_template('go.html', **results, **template_args)
         
         # añadimos un registro al log con info de la consulta realizada
         now = datetime.now()
@@ -122,12 +171,11 @@ def go():
                         request.full_path,
                         city_name)
         
-        # mostramos la página go.html con los resultados de la búsqueda
-        return render_template('go.html', ids=ids, graphJSON=graphJSON, 
-                                city_name=city_name,
-                                wiki_link = df_data_geo.iloc[elemento]['wiki_link'],
-                                tables=[table_html], 
-                                titles=df_data_meteo.columns.values) 
+        # una vez servida la localización elegida, precargamos en segundo 
+        # plano los datos meteorológicos de las siguientes
+        prefetch_meteo(df_data_geo, elemento, user_name)
+        
+        return html
                                         
     else:
         # si la búsqueda de localizaciones no ha dado resultado